@@ -4,18 +4,402 @@
 # This software is licensed under the MIT License.
 # See the LICENSE file for more details.
 
+import copy
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
+import joblib
+import sklearn
+from joblib import Parallel, delayed
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import accuracy_score, precision_score, recall_score, confusion_matrix
+from .data_processing import hash_array, write_atomic
 
-def classify_pixels(data_cube, ground_truth):
+# ONNX Runtime is optional: when it is available the fitted forest is compiled
+# into a native graph for whole-cube inference, otherwise sklearn is used.
+try:
+    import onnxruntime as ort
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+except ImportError:
+    ort = None
+
+# Numba is optional: when available the flattened trees are walked by a
+# compiled kernel that runs in parallel across pixels.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _walk_forest_kernel(X, roots, feature, threshold, children_left, children_right, value, votes, out):
+        n_classes = value.shape[1]
+        for i in prange(X.shape[0]):
+            for t in range(roots.shape[0]):
+                node = roots[t]
+                while children_left[node] != -1:
+                    if X[i, feature[node]] <= threshold[node]:
+                        node = children_left[node]
+                    else:
+                        node = children_right[node]
+                for c in range(n_classes):
+                    votes[i, c] += value[node, c]
+            out[i] = np.argmax(votes[i])
+
+# RAPIDS cuML is optional: on hosts with an NVIDIA GPU the forest is loaded into
+# the Forest Inference Library and whole-cube prediction runs on the device.
+try:
+    import cupy
+    from cuml import ForestInference
+except ImportError:
+    ForestInference = None
+
+def _convert_to_onnx(rf, n_features):
+    """
+    Converts a fitted Random Forest to a serialized ONNX model.
+
+    Args:
+        rf (RandomForestClassifier): The fitted classifier.
+        n_features (int): The number of input features (spectral bands).
+
+    Returns:
+        bytes or None: The serialized model, or None if ONNX Runtime is unavailable.
+    """
+    if ort is None:
+        return None
+    initial_type = [('X', FloatTensorType([None, n_features]))]
+    onx = convert_sklearn(rf, initial_types=initial_type, options={id(rf): {'zipmap': False}})
+    return onx.SerializeToString()
+
+def _load_or_convert_onnx(rf, n_features, onnx_path=None):
+    """
+    Returns the serialized ONNX model for a forest, converting it only if needed.
+
+    Conversion takes longer than predicting a Salinas-sized map with sklearn, so
+    the bytes are cached at `onnx_path` (next to the cached forest) when given.
+
+    Args:
+        rf (RandomForestClassifier): The fitted classifier.
+        n_features (int): The number of input features (spectral bands).
+        onnx_path (str or None): Where the converted model is cached. None disables caching.
+
+    Returns:
+        bytes or None: The serialized model, or None if ONNX Runtime is unavailable.
+    """
+    if ort is None:
+        return None
+    if onnx_path and os.path.exists(onnx_path):
+        with open(onnx_path, 'rb') as f:
+            return f.read()
+
+    onnx_model = _convert_to_onnx(rf, n_features)
+    if onnx_path:
+        try:
+            write_atomic(onnx_path, lambda f: f.write(onnx_model))
+        except OSError as e:
+            print(f"Warning: Could not save ONNX model to {onnx_path}: {e}")
+    return onnx_model
+
+def _build_onnx_session(onnx_model):
+    """
+    Opens an ONNX Runtime inference session for a serialized model, if there is one.
+    """
+    if ort is None or onnx_model is None:
+        return None
+    return ort.InferenceSession(onnx_model, providers=['CPUExecutionProvider'])
+
+def _fit_subforest(X, y, n_trees, seed, hparams, n_jobs):
+    """
+    Trains a Random Forest with `n_trees` trees. Runs inside a worker process.
+    """
+    rf = RandomForestClassifier(**{**hparams, "n_estimators": n_trees}, random_state=seed, n_jobs=n_jobs)
+    return rf.fit(X, y)
+
+def _fit_forest(X, y, hparams):
+    """
+    Trains a Random Forest as two half-forests in separate processes and merges them.
+
+    Each process fits a disjoint subset of the trees on its own share of the cores,
+    and the fitted trees are concatenated into a single forest. Single-core hosts
+    and single-tree forests fall back to one in-process fit.
+
+    Args:
+        X (np.ndarray): The training pixels.
+        y (np.ndarray): The training labels.
+        hparams (dict): Keyword arguments for RandomForestClassifier, including n_estimators.
+
+    Returns:
+        RandomForestClassifier: The fitted classifier.
+    """
+    n_cpus = os.cpu_count() or 1
+    n_estimators = hparams["n_estimators"]
+    if n_cpus < 2 or n_estimators < 2:
+        return _fit_subforest(X, y, n_estimators, 42, hparams, -1)
+
+    half = n_estimators // 2
+    n_jobs = max(1, n_cpus // 2)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        future_a = executor.submit(_fit_subforest, X, y, half, 42, hparams, n_jobs)
+        future_b = executor.submit(_fit_subforest, X, y, n_estimators - half, 43, hparams, n_jobs)
+        rf_a, rf_b = future_a.result(), future_b.result()
+
+    rf = copy.copy(rf_a)
+    rf.estimators_ = rf_a.estimators_ + rf_b.estimators_
+    rf.n_estimators = n_estimators
+    rf.n_jobs = -1
+    return rf
+
+# Bump whenever the way forests are fitted or stored changes, so models
+# cached by an older version are retrained instead of silently reused
+MODEL_CACHE_VERSION = 3
+
+def _cache_key(data_cube, ground_truth, hparams):
+    """
+    Hashes the input arrays and hyperparameters into a key for the model cache.
+    The key also covers MODEL_CACHE_VERSION and the installed scikit-learn version,
+    since pickled forests are not portable across sklearn releases.
+    """
+    digest = hashlib.sha1(f"v{MODEL_CACHE_VERSION}-sklearn{sklearn.__version__}".encode())
+    for array in (data_cube, ground_truth):
+        digest.update(hash_array(array).encode())
+    digest.update(repr(sorted(hparams.items())).encode())
+    return digest.hexdigest()
+
+def _load_or_fit_forest(X, y, hparams, cache_key, model_dir):
+    """
+    Loads a previously trained forest from `model_dir`, or trains and saves a new one.
+
+    Args:
+        X (np.ndarray): The training pixels.
+        y (np.ndarray): The training labels.
+        hparams (dict): Keyword arguments for RandomForestClassifier.
+        cache_key (str): The key identifying this data and configuration.
+        model_dir (str or None): The directory holding cached models. None disables caching.
+
+    Returns:
+        RandomForestClassifier: The fitted classifier.
+    """
+    model_path = os.path.join(model_dir, f"{cache_key}.joblib") if model_dir else None
+    if model_path and os.path.exists(model_path):
+        try:
+            rf = joblib.load(model_path)
+            print(f"Loaded cached Random Forest from {model_path}")
+            return rf
+        except Exception as e:
+            print(f"Warning: Could not load cached model {model_path}: {e}")
+
+    print("Training Random Forest classifier...")
+    rf = _fit_forest(X, y, hparams)
+    print("Training complete.")
+
+    if model_path:
+        try:
+            os.makedirs(model_dir, exist_ok=True)
+            write_atomic(model_path, lambda f: joblib.dump(rf, f, compress=3))
+        except OSError as e:
+            print(f"Warning: Could not save model to {model_path}: {e}")
+
+    return rf
+
+def _predict_forest(rf, X):
+    """
+    Predicts class labels by averaging per-tree probabilities computed in threads.
+
+    sklearn's tree prediction releases the GIL, so a threading backend scales
+    across cores without the process start-up and pickling cost of loky.
+    Small batches are scored serially since dispatch would dominate.
+
+    Args:
+        rf (RandomForestClassifier): The fitted classifier.
+        X (np.ndarray): The (n_samples, n_features) input matrix.
+
+    Returns:
+        np.ndarray: The predicted class labels.
+    """
+    if X.shape[0] < 3 * len(rf.estimators_):
+        tree_probas = (tree.predict_proba(X) for tree in rf.estimators_)
+    else:
+        # As a generator only a few trees' outputs are alive at any time
+        tree_probas = Parallel(n_jobs=-1, backend='threading', return_as='generator')(
+            delayed(tree.predict_proba)(X) for tree in rf.estimators_
+        )
+    # Accumulate into one array instead of stacking every tree's output
+    proba = np.zeros((X.shape[0], len(rf.classes_)))
+    for tree_proba in tree_probas:
+        proba += tree_proba
+    proba /= len(rf.estimators_)
+    return rf.classes_[proba.argmax(axis=1)]
+
+def _predict(rf, X, small_threshold=20_000):
+    """
+    Predicts with sklearn, running serially for small batches.
+
+    Joblib dispatch dominates when only a few thousand pixels are scored, so
+    `n_jobs` is set to 1 below `small_threshold` rows and restored afterwards.
+
+    Args:
+        rf (RandomForestClassifier): The fitted classifier.
+        X (np.ndarray): The (n_samples, n_features) input matrix.
+        small_threshold (int): Batches with fewer rows than this are predicted serially.
+
+    Returns:
+        np.ndarray: The predicted class labels.
+    """
+    old_n_jobs = rf.n_jobs
+    rf.n_jobs = 1 if X.shape[0] < small_threshold else -1
+    try:
+        return rf.predict(X)
+    finally:
+        rf.n_jobs = old_n_jobs
+
+def _stratified_subsample(y, max_per_class, random_state=42):
+    """
+    Selects at most `max_per_class` samples of every class.
+
+    Args:
+        y (np.ndarray): The class labels.
+        max_per_class (int): The maximum number of samples kept per class.
+        random_state (int): Seed for the random selection.
+
+    Returns:
+        np.ndarray: The sorted indices of the selected samples.
+    """
+    rng = np.random.default_rng(random_state)
+    keep = []
+    for cls in np.unique(y):
+        cls_idx = np.flatnonzero(y == cls)
+        if len(cls_idx) > max_per_class:
+            cls_idx = rng.choice(cls_idx, max_per_class, replace=False)
+        keep.append(cls_idx)
+    return np.sort(np.concatenate(keep))
+
+def _predict_onnx(session, X):
+    """Predicts class labels with an ONNX Runtime session."""
+    return session.run(None, {'X': X})[0].ravel()
+
+def _predict_fil(fil_model, classes, X):
+    """Predicts class labels on the GPU with a cuML Forest Inference model."""
+    class_idx = cupy.asnumpy(fil_model.predict(cupy.asarray(X, dtype=cupy.float32)))
+    # FIL returns the index of the winning class, not the label itself
+    return classes[class_idx.astype(np.intp).ravel()]
+
+def _flatten_forest(rf):
+    """
+    Concatenates the node arrays of every tree in a fitted forest.
+
+    Child indices are offset into the concatenated arrays (leaves keep -1), and
+    leaf values are normalized to class probabilities as in predict_proba.
+
+    Args:
+        rf (RandomForestClassifier): The fitted classifier.
+
+    Returns:
+        tuple: The (roots, feature, threshold, children_left, children_right, value) arrays.
+    """
+    roots, feature, threshold, children_left, children_right, value = [], [], [], [], [], []
+    offset = 0
+    for estimator in rf.estimators_:
+        tree = estimator.tree_
+        roots.append(offset)
+        feature.append(tree.feature)
+        threshold.append(tree.threshold)
+        children_left.append(np.where(tree.children_left == -1, -1, tree.children_left + offset))
+        children_right.append(np.where(tree.children_right == -1, -1, tree.children_right + offset))
+        node_value = tree.value[:, 0, :]
+        value.append(node_value / np.maximum(node_value.sum(axis=1, keepdims=True), 1e-12))
+        offset += tree.node_count
+    return (
+        np.asarray(roots, dtype=np.intp),
+        np.concatenate(feature).astype(np.intp),
+        np.concatenate(threshold),
+        np.concatenate(children_left).astype(np.intp),
+        np.concatenate(children_right).astype(np.intp),
+        np.concatenate(value),
+    )
+
+def _predict_numba(flat_forest, classes, X):
+    """Predicts class labels by walking the flattened forest with the Numba kernel."""
+    roots, feature, threshold, children_left, children_right, value = flat_forest
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    votes = np.zeros((X.shape[0], value.shape[1]), dtype=np.float64)
+    out = np.empty(X.shape[0], dtype=np.intp)
+    _walk_forest_kernel(X, roots, feature, threshold, children_left, children_right, value, votes, out)
+    return classes[out]
+
+PREDICTION_BACKENDS = ('auto', 'cuml', 'onnx', 'numba', 'threads')
+
+def _build_predictor(rf, n_features, backend='auto', onnx_path=None):
+    """
+    Builds the prediction function for whole-map prediction.
+
+    With backend='auto' the fastest available backend is picked, in the order
+    cuML on the GPU, then ONNX Runtime, then the Numba forest walker, then
+    per-tree threads. ONNX is only picked automatically when `onnx_path` is
+    given, since converting the forest costs more than one map prediction and
+    only pays off once the conversion is cached. Naming a backend forces it,
+    which is mainly useful for checking that every backend agrees with sklearn.
+
+    Args:
+        rf (RandomForestClassifier): The fitted classifier.
+        n_features (int): The number of input features (spectral bands).
+        backend (str): One of 'auto', 'cuml', 'onnx', 'numba' or 'threads'.
+        onnx_path (str or None): Where the ONNX conversion of `rf` is cached, if anywhere.
+
+    Returns:
+        callable: A function mapping an (n_pixels, n_bands) float32 array to class labels.
+    """
+    if backend not in PREDICTION_BACKENDS:
+        raise ValueError(f"Unknown prediction backend '{backend}', expected one of {PREDICTION_BACKENDS}")
+
+    if backend in ('auto', 'cuml'):
+        if ForestInference is not None:
+            try:
+                fil_model = ForestInference.load_from_sklearn(rf, output_class=True)
+                return partial(_predict_fil, fil_model, rf.classes_)
+            except Exception as e:
+                if backend == 'cuml':
+                    raise
+                print(f"Warning: cuML Forest Inference unavailable, using the CPU: {e}")
+        elif backend == 'cuml':
+            raise ValueError("The 'cuml' backend requires cuml and cupy to be installed.")
+
+    if backend == 'onnx' or (backend == 'auto' and onnx_path is not None):
+        session = _build_onnx_session(_load_or_convert_onnx(rf, n_features, onnx_path))
+        if session is not None:
+            return partial(_predict_onnx, session)
+        if backend == 'onnx':
+            raise ValueError("The 'onnx' backend requires onnxruntime and skl2onnx to be installed.")
+
+    if backend in ('auto', 'numba'):
+        if njit is not None:
+            return partial(_predict_numba, _flatten_forest(rf), rf.classes_)
+        if backend == 'numba':
+            raise ValueError("The 'numba' backend requires numba to be installed.")
+
+    return partial(_predict_forest, rf)
+
+def classify_pixels(data_cube, ground_truth, n_estimators=100, max_depth=16, min_samples_leaf=5,
+                    max_train_samples_per_class=20000, preview=False, model_dir='models', backend='auto'):
     """
     Trains a Random Forest classifier and classifies the hyperspectral data.
 
     Args:
         data_cube (np.ndarray): The hyperspectral data cube.
         ground_truth (np.ndarray): The ground truth map.
+        n_estimators (int): The number of trees in the forest.
+        max_depth (int or None): The maximum depth of each tree. None grows trees until the leaves are pure.
+        min_samples_leaf (int): The minimum number of samples required at a leaf node.
+        max_train_samples_per_class (int or None): Caps the training pixels used per class. None uses them all.
+        preview (bool): If True, the map is predicted on every second pixel in each direction and
+            upsampled, which is enough for display. Use False for a full-resolution map.
+        model_dir (str or None): Directory where trained models are cached, keyed by a hash of the
+            inputs and hyperparameters. None always retrains without saving.
+        backend (str): The map prediction backend, one of 'auto', 'cuml', 'onnx', 'numba' or 'threads'.
+            'auto' uses the fastest one available.
 
     Returns:
         tuple: A tuple containing:
@@ -23,35 +407,53 @@ def classify_pixels(data_cube, ground_truth):
             - metrics (dict): A dictionary with performance metrics.
     """
     # Reshape the data for classification
-    # Flatten the spatial dimensions (height, width) into a single list of pixels
+    # Flatten the spatial dimensions (height, width) into a single list of pixels.
+    # float32 matches what sklearn trees and ONNX Runtime use internally, so the
+    # cast happens once here rather than on every fit/predict call.
     h, w, bands = data_cube.shape
-    X = data_cube.reshape((h * w, bands))
+    X = data_cube.reshape((h * w, bands)).astype(np.float32, copy=False)
 
     # Flatten the ground truth map
     y = ground_truth.ravel()
 
     # Filter out un-labeled pixels (class 0)
     # The model should only be trained on pixels with known labels
-    X_labeled = X[y != 0]
-    y_labeled = y[y != 0]
+    labeled_idx = np.flatnonzero(y != 0)
+    X_labeled = X[labeled_idx]
+    y_labeled = y[labeled_idx]
 
     if len(y_labeled) == 0:
         print("No labeled data available for training.")
         return None, None
 
-    # Split the labeled data into training and testing sets
-    X_train, X_test, y_train, y_test = train_test_split(
-        X_labeled, y_labeled, test_size=0.3, random_state=42, stratify=y_labeled
+    # Split the labeled data into training and testing sets, keeping track of
+    # where each pixel sits in the flattened map
+    X_train, X_test, y_train, y_test, idx_train, idx_test = train_test_split(
+        X_labeled, y_labeled, labeled_idx, test_size=0.3, random_state=42, stratify=y_labeled
     )
 
-    # Initialize and train the Random Forest classifier
-    print("Training Random Forest classifier...")
-    rf = RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=-1)
-    rf.fit(X_train, y_train)
-    print("Training complete.")
+    # Large classes add fit time without adding much information, so cap them
+    if max_train_samples_per_class is not None:
+        fit_idx = _stratified_subsample(y_train, max_train_samples_per_class)
+        X_fit, y_fit = X_train[fit_idx], y_train[fit_idx]
+    else:
+        X_fit, y_fit = X_train, y_train
+
+    # Initialize and train the Random Forest classifier, or reuse a cached one
+    hparams = {
+        "n_estimators": n_estimators,
+        "max_depth": max_depth,
+        "min_samples_leaf": min_samples_leaf,
+    }
+    cache_key = _cache_key(
+        data_cube, ground_truth, {**hparams, "max_train_samples_per_class": max_train_samples_per_class}
+    )
+    rf = _load_or_fit_forest(X_fit, y_fit, hparams, cache_key, model_dir)
+    onnx_path = os.path.join(model_dir, f"{cache_key}.onnx") if model_dir else None
+    predict_pixels = _build_predictor(rf, bands, backend, onnx_path)
 
     # Evaluate the model on the test set
-    y_pred_test = rf.predict(X_test)
+    y_pred_test = _predict(rf, X_test)
 
     metrics = {
         "overall_accuracy": accuracy_score(y_test, y_pred_test),
@@ -60,22 +462,49 @@ def classify_pixels(data_cube, ground_truth):
         "confusion_matrix": confusion_matrix(y_test, y_pred_test).tolist() # convert to list for easy display
     }
 
-    # Predict the class for every pixel in the entire cube
-    print("Generating full classification map...")
-    y_pred_full = rf.predict(X)
-    classification_map = y_pred_full.reshape((h, w))
+    if preview:
+        # Predict a quarter of the pixels and upsample with nearest neighbour
+        print("Generating preview classification map...")
+        X_grid = X.reshape((h, w, bands))[::2, ::2].reshape((-1, bands))
+        grid_map = predict_pixels(X_grid).astype(y.dtype)
+        grid_map = grid_map.reshape(((h + 1) // 2, (w + 1) // 2))
+        classification_map = np.repeat(np.repeat(grid_map, 2, axis=0), 2, axis=1)[:h, :w]
+        classification_map[ground_truth == 0] = 0
+    else:
+        # Only labeled pixels are shown on the map, so predict just those.
+        # Unlabeled pixels stay 0 and the test-set predictions are reused as-is.
+        print("Generating full classification map...")
+        classification_map = np.zeros(h * w, dtype=y.dtype)
+        classification_map[idx_test] = y_pred_test
+        classification_map[idx_train] = predict_pixels(X_train)
+        classification_map = classification_map.reshape((h, w))
     print("Classification map generated.")
 
-    # Set unlabeled pixels (class 0 in ground truth) back to 0 in the classification map
-    classification_map[ground_truth == 0] = 0
-
     return classification_map, metrics
 
 if __name__ == '__main__':
-    # This test requires the data loading functions
-    from data_processing import load_salinas_data
+    # This test requires the data loading functions.
+    # Run as a module from the project root: python -m analysis_backend.classification
+    from .data_processing import load_salinas_data
+
+    print("--- Testing Prediction Backends ---")
+    # Every available backend must reproduce sklearn's labels on a small synthetic forest
+    rng = np.random.default_rng(0)
+    X_check = rng.normal(size=(2000, 20)).astype(np.float32)
+    y_check = 1 + (X_check[:, 0] > 0) + 2 * (X_check[:, 1] > 0.5)
+    rf_check = RandomForestClassifier(n_estimators=20, max_depth=8, random_state=0).fit(X_check, y_check)
+    expected = rf_check.predict(X_check)
+    for backend_name in PREDICTION_BACKENDS[1:]:
+        try:
+            predict_check = _build_predictor(rf_check, X_check.shape[1], backend_name)
+        except ValueError as e:
+            print(f"  {backend_name}: skipped ({e})")
+            continue
+        assert np.array_equal(predict_check(X_check), expected), f"{backend_name} disagrees with rf.predict"
+        print(f"  {backend_name}: matches rf.predict")
+    assert np.array_equal(_predict(rf_check, X_check), expected)
 
-    print("--- Testing Classification Module ---")
+    print("\n--- Testing Classification Module ---")
     data_file = 'data/SalinasA.mat'
     gt_file = 'data/SalinasA_gt.mat'
 
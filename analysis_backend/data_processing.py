@@ -4,12 +4,100 @@
 # This software is licensed under the MIT License.
 # See the LICENSE file for more details.
 
+import hashlib
+import os
+import tempfile
 import scipy.io
 import numpy as np
 
+def hash_array(array):
+    """
+    Hashes a NumPy array by shape, dtype and content.
+
+    Args:
+        array (np.ndarray): The array to hash.
+
+    Returns:
+        str: The SHA-1 hex digest of the array.
+    """
+    digest = hashlib.sha1(f"{array.shape}{array.dtype}".encode())
+    digest.update(np.ascontiguousarray(array).view(np.uint8))
+    return digest.hexdigest()
+
+def write_atomic(path, write):
+    """
+    Writes a file atomically, so readers never see a partially written file.
+
+    `write` is called with a binary file object for a uniquely named temporary
+    file in the same directory, which then replaces `path`. The temporary file
+    is removed if anything fails, and the error is re-raised.
+
+    Args:
+        path (str): The destination file path.
+        write (callable): Writes the contents to the given file object.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _load_mat_array(mat_path):
+    """
+    Loads the single array stored in a .mat file, caching it as a .npy file.
+
+    The first load reads the .mat file and writes a .npy copy next to it.
+    Later loads memory-map that copy instead of reading the whole file into RAM.
+    The cache is ignored if it is older than the .mat file, and rebuilt from the
+    .mat file if it cannot be read.
+
+    Args:
+        mat_path (str): The file path to the .mat file.
+
+    Returns:
+        np.ndarray: The stored array, read-only and memory-mapped when the cache is used.
+    """
+    npy_path = os.path.splitext(mat_path)[0] + '.npy'
+    mat_mtime = os.path.getmtime(mat_path)
+    if os.path.exists(npy_path) and os.path.getmtime(npy_path) >= mat_mtime:
+        try:
+            return np.load(npy_path, mmap_mode='r')
+        except Exception as e:
+            print(f"Warning: Could not read cache file {npy_path}, reloading {mat_path}: {e}")
+
+    mat = scipy.io.loadmat(mat_path)
+    key = [k for k in mat.keys() if not k.startswith('__')][0]
+    array = mat[key]
+    try:
+        write_atomic(npy_path, lambda f: np.save(f, array))
+    except OSError as e:
+        print(f"Warning: Could not write cache file {npy_path}: {e}")
+    return array
+
+def to_band_major(data_cube):
+    """
+    Converts a (height, width, bands) cube to a C-contiguous float32 (bands, height, width) cube.
+
+    In this layout each band is one contiguous block, so single-band reads such
+    as the vegetation indices do not stride over every other band. Classification
+    still uses the pixel-major cube, which flattens to one row per pixel.
+
+    Args:
+        data_cube (np.ndarray): The hyperspectral data cube in (height, width, bands) layout.
+
+    Returns:
+        np.ndarray: The band-major data cube.
+    """
+    return np.ascontiguousarray(data_cube.transpose(2, 0, 1), dtype=np.float32)
+
 def load_salinas_data(data_path, gt_path=None):
     """
     Loads the Salinas hyperspectral data and, optionally, its ground truth map.
+    Each array is cached as a .npy file beside its .mat file and memory-mapped on later loads.
 
     Args:
         data_path (str): The file path to the Salinas .mat data file.
@@ -22,9 +110,7 @@ def load_salinas_data(data_path, gt_path=None):
     """
     data_cube, ground_truth = None, None
     try:
-        data_mat = scipy.io.loadmat(data_path)
-        data_key = [k for k in data_mat.keys() if not k.startswith('__')][0]
-        data_cube = data_mat[data_key]
+        data_cube = _load_mat_array(data_path)
         print(f"Data cube loaded with shape: {data_cube.shape}")
     except FileNotFoundError:
         print(f"Error: Data file not found at {data_path}")
@@ -35,9 +121,7 @@ def load_salinas_data(data_path, gt_path=None):
 
     if gt_path:
         try:
-            gt_mat = scipy.io.loadmat(gt_path)
-            gt_key = [k for k in gt_mat.keys() if not k.startswith('__')][0]
-            ground_truth = gt_mat[gt_key]
+            ground_truth = _load_mat_array(gt_path)
             print(f"Ground truth loaded with shape: {ground_truth.shape}")
         except FileNotFoundError:
             print(f"Warning: Ground truth file not found at {gt_path}")
@@ -6,63 +6,188 @@
 
 import numpy as np
 
-def calculate_ndvi(data_cube):
+# Bands for AVIRIS sensor (0-indexed)
+RED_BAND = 31        # 660.7 nm
+RED_EDGE_BAND = 38   # 717.0 nm
+NIR_BAND = 53        # 859.5 nm
+SWIR_BAND = 135      # 1650 nm
+
+# Numba is optional: when available the index formulas run as fused, parallel
+# kernels with no temporaries, otherwise plain NumPy expressions are used.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _normalized_difference_kernel(a_band, b_band, offset, scale, out):
+        for i in prange(a_band.shape[0]):
+            for j in range(a_band.shape[1]):
+                a = a_band[i, j]
+                b = b_band[i, j]
+                out[i, j] = ((a - b) / (a + b + offset)) * scale
+
+def _band(data_cube, index, band_major=False):
+    """
+    Extracts a single band as a C-contiguous float32 array.
+    For a float32 band-major (bands, height, width) cube this is a zero-copy view.
+    """
+    band = data_cube[index] if band_major else data_cube[:, :, index]
+    return np.ascontiguousarray(band, dtype=np.float32)
+
+def _normalized_difference(a_band, b_band, L=0.0, out=None):
+    """
+    Computes ((A - B) / (A + B + L)) * (1 + L), the shared form of all the indices.
+    With L = 0 this is the plain normalized difference.
+
+    The result is written into `out` if given. The NumPy fallback works in place
+    with ufuncs and one float32 scratch buffer.
+    """
+    epsilon = 1e-10
+    if out is None:
+        out = np.empty(a_band.shape, dtype=np.float32)
+    elif out.shape != a_band.shape or out.dtype != np.float32:
+        # The Numba kernel does no bounds checking, so a mismatched buffer must be rejected here
+        raise ValueError(
+            f"out must be a float32 array of shape {a_band.shape}, got {out.dtype} array of shape {out.shape}"
+        )
+    if njit is not None:
+        _normalized_difference_kernel(a_band, b_band, np.float32(L + epsilon), np.float32(1 + L), out)
+        return out
+    scratch = np.empty(a_band.shape, dtype=np.float32)
+    np.subtract(a_band, b_band, out=out)
+    np.add(a_band, b_band, out=scratch)
+    np.add(scratch, L + epsilon, out=scratch)
+    np.divide(out, scratch, out=out)
+    if L:
+        np.multiply(out, 1 + L, out=out)
+    return out
+
+def calculate_ndvi(data_cube, out=None, band_major=False):
     """
     Calculates the Normalized Difference Vegetation Index (NDVI).
     NDVI = (NIR - Red) / (NIR + Red)
+    If `out` (a float32 array of shape (H, W)) is given, the result is written into it.
+    Pass band_major=True for a (bands, H, W) cube from to_band_major.
     """
-    # Bands for AVIRIS sensor (0-indexed)
-    # Red: Band 31 (660.7 nm)
-    # NIR: Band 53 (859.5 nm)
-    red_band = data_cube[:, :, 31].astype(float)
-    nir_band = data_cube[:, :, 53].astype(float)
+    red_band = _band(data_cube, RED_BAND, band_major)
+    nir_band = _band(data_cube, NIR_BAND, band_major)
 
-    epsilon = 1e-10
-    ndvi = (nir_band - red_band) / (nir_band + red_band + epsilon)
-    return ndvi
+    return _normalized_difference(nir_band, red_band, out=out)
+
+def calculate_ndvi_at(data_cube, mask):
+    """
+    Calculates NDVI only at the pixels selected by a boolean (H, W) mask.
+    Only the red and NIR values of those pixels are read, so the cost scales
+    with the number of selected pixels rather than with the whole map.
+
+    Returns:
+        np.ndarray: A 1-D float32 array with the NDVI of each selected pixel.
+    """
+    red_band = np.ascontiguousarray(data_cube[mask, RED_BAND], dtype=np.float32)
+    nir_band = np.ascontiguousarray(data_cube[mask, NIR_BAND], dtype=np.float32)
+
+    # The kernel works on 2-D maps, so treat the gathered pixels as a single row
+    return _normalized_difference(nir_band[np.newaxis], red_band[np.newaxis])[0]
 
-def calculate_savi(data_cube):
+def calculate_savi(data_cube, out=None, band_major=False):
     """
     Calculates the Soil-Adjusted Vegetation Index (SAVI).
     SAVI = ((NIR - Red) / (NIR + Red + L)) * (1 + L)
+    If `out` (a float32 array of shape (H, W)) is given, the result is written into it.
+    Pass band_major=True for a (bands, H, W) cube from to_band_major.
     """
-    # Red: Band 31 (660.7 nm)
-    # NIR: Band 53 (859.5 nm)
     L = 0.5  # Soil brightness correction factor
-    red_band = data_cube[:, :, 31].astype(float)
-    nir_band = data_cube[:, :, 53].astype(float)
+    red_band = _band(data_cube, RED_BAND, band_major)
+    nir_band = _band(data_cube, NIR_BAND, band_major)
 
-    epsilon = 1e-10
-    savi = ((nir_band - red_band) / (nir_band + red_band + L + epsilon)) * (1 + L)
-    return savi
+    return _normalized_difference(nir_band, red_band, L, out=out)
 
-def calculate_ndwi(data_cube):
+def calculate_ndwi(data_cube, out=None, band_major=False):
     """
     Calculates the Normalized Difference Water Index (NDWI).
     NDWI = (NIR - SWIR) / (NIR + SWIR)
+    If `out` (a float32 array of shape (H, W)) is given, the result is written into it.
+    Pass band_major=True for a (bands, H, W) cube from to_band_major.
     """
-    # NIR: Band 53 (859.5 nm)
-    # SWIR: Band 135 (1650 nm)
-    nir_band = data_cube[:, :, 53].astype(float)
-    swir_band = data_cube[:, :, 135].astype(float)
+    nir_band = _band(data_cube, NIR_BAND, band_major)
+    swir_band = _band(data_cube, SWIR_BAND, band_major)
 
-    epsilon = 1e-10
-    ndwi = (nir_band - swir_band) / (nir_band + swir_band + epsilon)
-    return ndwi
+    return _normalized_difference(nir_band, swir_band, out=out)
 
-def calculate_ndre(data_cube):
+def calculate_ndre(data_cube, out=None, band_major=False):
     """
     Calculates the Normalized Difference Red Edge Index (NDRE).
     NDRE = (NIR - Red Edge) / (NIR + Red Edge)
+    If `out` (a float32 array of shape (H, W)) is given, the result is written into it.
+    Pass band_major=True for a (bands, H, W) cube from to_band_major.
     """
-    # NIR: Band 53 (859.5 nm)
-    # Red Edge: Band 38 (717.0 nm)
-    nir_band = data_cube[:, :, 53].astype(float)
-    red_edge_band = data_cube[:, :, 38].astype(float)
+    nir_band = _band(data_cube, NIR_BAND, band_major)
+    red_edge_band = _band(data_cube, RED_EDGE_BAND, band_major)
+
+    return _normalized_difference(nir_band, red_edge_band, out=out)
 
+def _red_nir_indices(nir_band, red_band, which):
+    """
+    Computes NDVI and/or SAVI with NumPy, sharing the NIR - Red and NIR + Red intermediates.
+    """
     epsilon = 1e-10
-    ndre = (nir_band - red_edge_band) / (nir_band + red_edge_band + epsilon)
-    return ndre
+    L = 0.5  # Soil brightness correction factor
+    results = {}
+    num = np.subtract(nir_band, red_band)
+    den = np.add(nir_band, red_band)
+    if 'ndvi' in which:
+        ndvi = np.add(den, epsilon, out=np.empty_like(den))
+        results['ndvi'] = np.divide(num, ndvi, out=ndvi)
+    if 'savi' in which:
+        savi = np.add(den, L + epsilon, out=np.empty_like(den))
+        np.divide(num, savi, out=savi)
+        results['savi'] = np.multiply(savi, 1 + L, out=savi)
+    return results
+
+def calculate_indices(data_cube, which=('ndvi', 'savi', 'ndwi', 'ndre'), band_major=False):
+    """
+    Calculates several vegetation indices in a single pass over the data cube.
+    Each band is extracted and cast to float32 once. With Numba every index is
+    a single fused kernel that is already parallel across rows. Without it NDVI
+    and SAVI share the NIR - Red and NIR + Red intermediates.
+
+    Args:
+        data_cube (np.ndarray): The hyperspectral data cube.
+        which (iterable of str): The indices to compute, any of 'ndvi', 'savi', 'ndwi' and 'ndre'.
+        band_major (bool): True if the cube is in (bands, height, width) layout, see to_band_major.
+
+    Returns:
+        dict: A dictionary mapping each requested index name to its 2D map.
+    """
+    which = tuple(which)
+    unknown = set(which) - {'ndvi', 'savi', 'ndwi', 'ndre'}
+    if unknown:
+        raise ValueError(f"Unknown vegetation indices: {sorted(unknown)}")
+
+    nir_band = _band(data_cube, NIR_BAND, band_major)
+    partner_bands = {}
+    if 'ndvi' in which or 'savi' in which:
+        partner_bands['ndvi'] = partner_bands['savi'] = _band(data_cube, RED_BAND, band_major)
+    if 'ndwi' in which:
+        partner_bands['ndwi'] = _band(data_cube, SWIR_BAND, band_major)
+    if 'ndre' in which:
+        partner_bands['ndre'] = _band(data_cube, RED_EDGE_BAND, band_major)
+
+    results = {}
+    if njit is not None:
+        for name in which:
+            L = 0.5 if name == 'savi' else 0.0
+            results[name] = _normalized_difference(nir_band, partner_bands[name], L)
+    else:
+        if 'ndvi' in which or 'savi' in which:
+            results.update(_red_nir_indices(nir_band, partner_bands['ndvi'], which))
+        for name in ('ndwi', 'ndre'):
+            if name in which:
+                results[name] = _normalized_difference(nir_band, partner_bands[name])
+
+    return {name: results[name] for name in which}
 
 if __name__ == '__main__':
     # Create a dummy data cube for testing
@@ -88,4 +213,20 @@ if __name__ == '__main__':
     print(f"NDRE map shape: {ndre_map.shape}, Min: {np.min(ndre_map):.2f}, Max: {np.max(ndre_map):.2f}")
     assert ndre_map.shape == (10, 10)
 
+    fused_maps = calculate_indices(dummy_cube)
+    print(f"Fused indices: {list(fused_maps.keys())}")
+    for name, single_map in [('ndvi', ndvi_map), ('savi', savi_map), ('ndwi', ndwi_map), ('ndre', ndre_map)]:
+        assert np.allclose(fused_maps[name], single_map, atol=1e-5)
+
+    field_mask = np.zeros((10, 10), dtype=bool)
+    field_mask[2:5, 3:8] = True
+    field_ndvi = calculate_ndvi_at(dummy_cube, field_mask)
+    assert field_ndvi.shape == (15,)
+    assert np.allclose(field_ndvi, ndvi_map[field_mask])
+
+    band_major_cube = np.ascontiguousarray(dummy_cube.transpose(2, 0, 1), dtype=np.float32)
+    band_major_maps = calculate_indices(band_major_cube, band_major=True)
+    for name, fused_map in fused_maps.items():
+        assert np.array_equal(band_major_maps[name], fused_map)
+
     print("\n--- All Index Calculation Tests Passed ---")
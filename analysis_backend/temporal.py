@@ -4,11 +4,13 @@
 # This software is licensed under the MIT License.
 # See the LICENSE file for more details.
 
+import warnings
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import matplotlib.pyplot as plt
 from .data_processing import load_salinas_data
-from .indices import calculate_ndvi
+from .indices import calculate_ndvi_at
 
 def simulate_ndvi_time_series(data_cube, ground_truth, field_class=1, num_steps=13):
     """
@@ -24,17 +26,15 @@ def simulate_ndvi_time_series(data_cube, ground_truth, field_class=1, num_steps=
         pd.DataFrame: A DataFrame with 'date' and 'ndvi' columns.
     """
     # Find pixels belonging to the specified class
-    field_pixels = np.where(ground_truth == field_class)
-    if len(field_pixels[0]) == 0:
+    field_mask = ground_truth == field_class
+    if not field_mask.any():
         print(f"No pixels found for class {field_class}. Using class 1 instead.")
-        field_pixels = np.where(ground_truth == 1)
-        if len(field_pixels[0]) == 0:
+        field_mask = ground_truth == 1
+        if not field_mask.any():
             raise ValueError("Could not find any labeled pixels to simulate time series.")
 
-
-    # Calculate the base NDVI for these pixels
-    base_ndvi = calculate_ndvi(data_cube)
-    avg_base_ndvi = np.mean(base_ndvi[field_pixels])
+    # Calculate the base NDVI over the field pixels only, rather than over the whole cube
+    avg_base_ndvi = float(np.mean(calculate_ndvi_at(data_cube, field_mask)))
 
     # Create a plausible seasonal curve (like a parabola)
     x = np.linspace(-1, 1, num_steps)
@@ -56,6 +56,14 @@ def simulate_ndvi_time_series(data_cube, ground_truth, field_class=1, num_steps=
 
     return df
 
+def _centered_windows(values, window):
+    """
+    Returns one row per point holding its centered window, aligned like pandas'
+    rolling(center=True). Positions past either end of the series are NaN.
+    """
+    padded = np.concatenate([np.full(window // 2, np.nan), values, np.full((window - 1) // 2, np.nan)])
+    return sliding_window_view(padded, window)
+
 def detect_anomalies(time_series_df, window=3, std_dev_threshold=2.0):
     """
     Detects anomalies in a time series using a rolling mean.
@@ -69,14 +77,29 @@ def detect_anomalies(time_series_df, window=3, std_dev_threshold=2.0):
         pd.DataFrame: The input DataFrame with added 'is_anomaly' boolean column.
     """
     df = time_series_df.copy()
-    df['rolling_mean'] = df['ndvi'].rolling(window=window, center=True, min_periods=1).mean()
-    df['rolling_std'] = df['ndvi'].rolling(window=window, center=True, min_periods=1).std()
-
-    # Define anomaly condition
-    df['is_anomaly'] = np.abs(df['ndvi'] - df['rolling_mean']) > (df['rolling_std'] * std_dev_threshold)
-
-    # Handle NaNs in rolling_std for the first/last elements
-    df['is_anomaly'] = df['is_anomaly'].fillna(False)
+    x = df['ndvi'].to_numpy(dtype=np.float64)
+
+    # Two-pass rolling statistics over explicit centered windows. NaNs (padding
+    # at the edges or missing values) are skipped, matching pandas' min_periods=1.
+    # Each window is shifted by its own minimum first, so a constant window has
+    # deviations of exactly 0 rather than rounding noise.
+    windows = _centered_windows(x, window)
+    with warnings.catch_warnings():
+        # All-NaN windows and single-point windows give NaN, as in pandas
+        warnings.simplefilter('ignore', RuntimeWarning)
+        shift = np.nanmin(windows, axis=1)
+        shifted = windows - shift[:, np.newaxis]
+        rolling_mean = shift + np.nanmean(shifted, axis=1)
+        # Sample (ddof=1) standard deviation; undefined where the window holds a single point
+        rolling_std = np.nanstd(shifted, axis=1, ddof=1)
+
+    # Define anomaly condition. Comparisons against a NaN std are False,
+    # so points without a defined std are never flagged.
+    is_anomaly = np.abs(x - rolling_mean) > (rolling_std * std_dev_threshold)
+
+    df['rolling_mean'] = rolling_mean
+    df['rolling_std'] = rolling_std
+    df['is_anomaly'] = is_anomaly
 
     return df
 
@@ -116,6 +139,16 @@ def plot_temporal_analysis(df, anomalies_df):
 if __name__ == '__main__':
     print("--- Testing Temporal Analysis Module (with Simulated Data) ---")
 
+    # 0. A flat series has no anomalies, whatever the window
+    flat_df = pd.DataFrame({
+        'date': pd.date_range(start='2023-01-01', periods=13, freq='14D'),
+        'ndvi': np.full(13, 0.05),
+    })
+    for flat_window in (3, 5):
+        flat_result = detect_anomalies(flat_df, window=flat_window, std_dev_threshold=1.0)
+        assert not flat_result['is_anomaly'].any(), "Validation failed: a flat series was flagged."
+    print("Flat series check passed.")
+
     # 1. Load base data to simulate from
     data_file = 'data/SalinasA.mat'
     gt_file = 'data/SalinasA_gt.mat'
@@ -18,7 +18,7 @@ import time
 import os
 
 # Import backend functions
-from analysis_backend.data_processing import load_salinas_data
+from analysis_backend.data_processing import load_salinas_data, to_band_major, hash_array
 from analysis_backend.indices import calculate_ndvi, calculate_savi, calculate_ndwi, calculate_ndre
 from analysis_backend.classification import classify_pixels
 from analysis_backend.temporal import simulate_ndvi_time_series, detect_anomalies, plot_temporal_analysis
@@ -34,13 +34,32 @@ st.set_page_config(
 # Cache the data loading to avoid reloading on every interaction
 @st.cache_data
 def cached_load_data(data_path, gt_path=None):
-    """A cached wrapper for the backend data loading function."""
-    return load_salinas_data(data_path, gt_path)
-
-@st.cache_data
-def run_classification_analysis(_data_cube, _ground_truth):
+    """
+    A cached wrapper for the backend data loading function.
+    The cube is cast once to C-contiguous float32, the dtype every analysis works in.
+    """
+    data_cube, ground_truth = load_salinas_data(data_path, gt_path)
+    if data_cube is not None:
+        data_cube = np.ascontiguousarray(data_cube, dtype=np.float32)
+    return data_cube, ground_truth
+
+# A resource cache so every session shares one read-only copy, keyed on the same paths as the loader
+@st.cache_resource
+def cached_band_major(data_path, gt_path=None):
+    """The loaded cube in band-major layout, for the vegetation index functions."""
+    data_cube, _ = cached_load_data(data_path, gt_path)
+    if data_cube is None:
+        return None
+    cube_cb = to_band_major(data_cube)
+    cube_cb.flags.writeable = False
+    return cube_cb
+
+# Keyed on the array contents and persisted to disk, so the classification is
+# not rerun after an app restart or when the same data is loaded again
+@st.cache_data(persist="disk", hash_funcs={np.ndarray: hash_array, np.memmap: hash_array})
+def run_classification_analysis(data_cube, ground_truth):
     with st.spinner('Training Random Forest and classifying pixels... This may take a moment.'):
-        class_map, metrics = classify_pixels(_data_cube, _ground_truth)
+        class_map, metrics = classify_pixels(data_cube, ground_truth, preview=True)
     return class_map, metrics
 
 @st.cache_data
@@ -164,10 +183,17 @@ with col2:
                     st.subheader(f"{vi_selection} Results")
                     index_calculators = {"NDVI": calculate_ndvi, "SAVI": calculate_savi, "NDWI": calculate_ndwi, "NDRE": calculate_ndre}
 
+                    # Indices read single bands, so use the shared band-major copy of the cube
+                    cube_cb = cached_band_major(default_data_path, default_gt_path)
+
                     with st.spinner(f'Calculating {vi_selection}...'):
-                        index_map = index_calculators[vi_selection](data_cube)
+                        index_map = index_calculators[vi_selection](cube_cb, band_major=True)
 
-                    display_map = (index_map - np.min(index_map)) / (np.max(index_map) - np.min(index_map))
+                    # Scale to [0, 1] in one output buffer instead of three full-size temporaries
+                    map_min = index_map.min()
+                    map_range = index_map.max() - map_min + 1e-12
+                    display_map = np.subtract(index_map, map_min)
+                    display_map *= 1.0 / map_range
                     st.session_state['overlay_map'] = display_map
                     st.session_state['overlay_bounds'] = [[36.30, -121.655], [36.32, -121.635]]
 